@@ -1,6 +1,12 @@
-from __future__ import print_function, absolute_import, division
-
+import os
+import copy
+import pickle
+import shutil
+import hashlib
 import warnings
+import numpy as np
+import dask
+import dask.array as da
 from astropy import units as u
 from astropy.io import registry as io_registry
 from radio_beam import Beam, Beams
@@ -13,6 +19,14 @@ from .. import wcs_utils
 
 from casa_formats_io import getdesc, coordsys_to_astropy_wcs, image_to_dask
 
+try:
+    import zarr
+    import fsspec  # noqa
+except ImportError:
+    ZARR_INSTALLED = False
+else:
+    ZARR_INSTALLED = True
+
 # Read and write from a CASA image. This has a few
 # complications. First, by default CASA does not return the
 # "python order" and so we either have to transpose the cube on
@@ -22,6 +36,173 @@ from casa_formats_io import getdesc, coordsys_to_astropy_wcs, image_to_dask
 # when writing but don't want them in memory. By default, try to
 # yield the same array in memory that we would get from astropy.
 
+# Converting the CASA coordinate system to a WCS means building a FITS header
+# and parsing it with wcslib, which is slow compared to the rest of the
+# metadata handling. Since the same image (or images sharing a coordinate
+# system) is often read many times, we cache the resulting WCS objects keyed
+# on a hash of the coordinate system record.
+_WCS_CACHE = {}
+_WCS_CACHE_SIZE = 128
+
+# Similarly, the table description (which contains the coordinate system,
+# units and beams) is cached per image, and is only parsed again if the
+# modification time or size of the table.dat file has changed.
+_DESC_CACHE = {}
+_DESC_CACHE_SIZE = 128
+
+# CASA tiles are small, so they are aggregated into larger dask chunks. The
+# default aggregated chunk size is chosen to give chunks of roughly 30Mb for
+# 32-bit data (CASA's default pixel type): this keeps the number of tasks in
+# the graph low while staying well within the chunk sizes recommended by dask.
+# Note that the chunk size is given as a number of elements rather than bytes
+# so that data and mask arrays end up with identical chunks.
+DEFAULT_TARGET_CHUNKSIZE = 30 * 2**20 // 4
+
+
+def _coordsys_to_wcs(coordsys):
+    """
+    Cached version of ``coordsys_to_astropy_wcs``. A copy of the cached WCS is
+    returned so that callers are free to modify it.
+    """
+
+    key = hashlib.blake2b(pickle.dumps(coordsys)).hexdigest()
+
+    if key not in _WCS_CACHE:
+        if len(_WCS_CACHE) >= _WCS_CACHE_SIZE:
+            _WCS_CACHE.pop(next(iter(_WCS_CACHE)))
+        _WCS_CACHE[key] = coordsys_to_astropy_wcs(coordsys)
+
+    return _WCS_CACHE[key].deepcopy()
+
+
+def _getdesc(filename):
+    """
+    Cached version of ``getdesc``. A copy of the cached description is
+    returned so that callers are free to modify it.
+    """
+
+    path = os.path.abspath(filename)
+    stat = os.stat(os.path.join(path, 'table.dat'))
+    signature = (stat.st_mtime_ns, stat.st_size)
+
+    if path not in _DESC_CACHE or _DESC_CACHE[path][0] != signature:
+        _DESC_CACHE.pop(path, None)
+        if len(_DESC_CACHE) >= _DESC_CACHE_SIZE:
+            _DESC_CACHE.pop(next(iter(_DESC_CACHE)))
+        _DESC_CACHE[path] = signature, getdesc(filename)
+
+    return copy.deepcopy(_DESC_CACHE[path][1])
+
+
+def clear_cache():
+    """
+    Clear the caches of CASA image metadata and WCS objects.
+    """
+    _DESC_CACHE.clear()
+    _WCS_CACHE.clear()
+
+
+def _casa_signature(filename):
+    """
+    Return the names, modification times and sizes of the files containing
+    the metadata, data and mask of a CASA image. This is used to check whether
+    a cached copy of the image is still up to date.
+    """
+    signature = []
+    for name in ('table.dat', 'table.f0_TSM0', 'mask0/table.f0_TSM0'):
+        path = os.path.join(filename, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            signature.append([name, stat.st_mtime_ns, stat.st_size])
+    return signature
+
+
+def _read_casa_arrays(filename, memmap=True, skipdata=False, skipvalid=False,
+                      target_chunksize=None):
+    """
+    Read the data and mask of a CASA image into dask arrays. Either may be
+    `None` if skipped or, for the mask, if the image does not have one.
+    """
+
+    # read in the data
+    if skipdata:
+        data = None
+    else:
+        data = image_to_dask(filename, memmap=memmap, target_chunksize=target_chunksize)
+
+    # CASA stores validity of data as a mask
+    if skipvalid:
+        valid = None
+    else:
+        try:
+            valid = image_to_dask(filename, memmap=memmap, mask=True, target_chunksize=target_chunksize)
+        except FileNotFoundError:
+            valid = None
+
+    return data, valid
+
+
+def _read_casa_arrays_cached(filename, cache_dir, memmap=True, skipdata=False,
+                             skipvalid=False, target_chunksize=None,
+                             scheduler_kwargs=None):
+    """
+    As for ``_read_casa_arrays``, but the data and mask are read from a zarr
+    copy of the image inside ``cache_dir``, which is (re-)created if it does
+    not exist or if the CASA image has changed since it was written.
+    """
+
+    if not ZARR_INSTALLED:
+        raise ImportError("caching CASA images to a directory requires the "
+                          "zarr and fsspec packages to be installed.")
+
+    # The dask chunks are those of the zarr store, so copies of the image made
+    # with different chunk sizes are kept separately
+    path = os.path.abspath(filename)
+    key = hashlib.blake2b(f"{path}:{target_chunksize}".encode(), digest_size=16).hexdigest()
+    cache_path = os.path.join(cache_dir, key + '.zarr')
+
+    signature = _casa_signature(filename)
+
+    if os.path.exists(cache_path):
+        try:
+            valid_cache = zarr.open_group(cache_path, mode='r').attrs.get('signature') == signature
+        except (ValueError, FileNotFoundError):
+            # The copy is incomplete or corrupted
+            valid_cache = False
+        if not valid_cache:
+            shutil.rmtree(cache_path)
+
+    if not os.path.exists(cache_path):
+        data, valid = _read_casa_arrays(filename, memmap=memmap,
+                                        target_chunksize=target_chunksize)
+        with dask.config.set(**(scheduler_kwargs or {'scheduler': 'synchronous'})):
+            data.to_zarr(cache_path, component='data')
+            if valid is not None:
+                valid.to_zarr(cache_path, component='mask')
+        # The signature is written last so that an incomplete copy is never
+        # considered valid
+        zarr.open_group(cache_path, mode='a').attrs['signature'] = signature
+
+    group = zarr.open_group(cache_path, mode='r')
+
+    if skipdata:
+        data = None
+    else:
+        data = da.from_zarr(cache_path, component='data')
+
+    if skipvalid or 'mask' not in group:
+        valid = None
+    else:
+        valid = da.from_zarr(cache_path, component='mask')
+
+    # As for image_to_dask, memmap=False means that the arrays are loaded
+    # into memory straight away
+    if not memmap:
+        with dask.config.set(**(scheduler_kwargs or {'scheduler': 'synchronous'})):
+            data, valid = dask.persist(data, valid)
+
+    return data, valid
+
 
 def is_casa_image(origin, filepath, fileobj, *args, **kwargs):
 
@@ -33,22 +214,53 @@ def is_casa_image(origin, filepath, fileobj, *args, **kwargs):
         elif isinstance(args[0], str):
             filepath = args[0]
 
-    return filepath is not None and filepath.lower().endswith('.image')
+    # Only lowercase the extension rather than the full path
+    return filepath is not None and filepath[-6:].lower() == '.image'
+
+
+def _beam_value(beam, param, unit):
+    """
+    Return the value of ``param`` for a CASA beam dictionary in ``unit``.
+    """
+    quantity = beam[param]
+    if quantity['unit'] == unit:
+        return quantity['value']
+    # CASA normally writes all beams with the same units, so only convert
+    # when needed
+    return u.Quantity(quantity['value'], quantity['unit']).to_value(unit)
 
 
 def load_casa_image(filename, skipdata=False, memmap=True,
                     skipvalid=False, skipcs=False, target_cls=None, use_dask=None,
-                    target_chunksize=None, **kwargs):
+                    target_chunksize=None, scheduler=None, num_workers=None,
+                    cache_dir=None, **kwargs):
     """
     Load a cube (into memory?) from a CASA image. By default it will transpose
     the cube into a 'python' order and drop degenerate axes. These options can
     be suppressed. The object holds the coordsys object from the image in
     memory.
+
+    The ``target_chunksize`` argument gives the maximum number of elements in
+    each dask chunk, and defaults to ``DEFAULT_TARGET_CHUNKSIZE``. Since the
+    chunks are read independently, the ``scheduler`` and ``num_workers``
+    arguments can be used to set the dask scheduler of the returned cube(s) so
+    that chunks are read in parallel (see
+    :meth:`~spectral_cube.DaskSpectralCube.use_dask_scheduler`).
+
+    If ``cache_dir`` is set, the data and mask are copied to a compressed zarr
+    store inside that directory the first time the image is read, and
+    subsequent reads use that copy directly instead of the CASA files. The
+    copy is updated if the CASA image changes, and a separate copy is kept for
+    each ``target_chunksize``. This requires the zarr and
+    fsspec packages.
     """
 
     if use_dask is None:
         use_dask = True
 
+    if target_chunksize is None:
+        target_chunksize = DEFAULT_TARGET_CHUNKSIZE
+
     if not use_dask:
         raise ValueError("Loading CASA datasets is not possible with use_dask=False")
 
@@ -56,24 +268,28 @@ def load_casa_image(filename, skipdata=False, memmap=True,
     if isinstance(filename, StringWrapper):
         filename = filename.value
 
-    # read in the data
-    if not skipdata:
-        data = image_to_dask(filename, memmap=memmap, target_chunksize=target_chunksize)
-
-    # CASA stores validity of data as a mask
-    if skipvalid:
-        valid = None
+    if scheduler is None:
+        scheduler_kwargs = None
     else:
-        try:
-            valid = image_to_dask(filename, memmap=memmap, mask=True, target_chunksize=target_chunksize)
-        except FileNotFoundError:
-            valid = None
+        scheduler_kwargs = {'scheduler': scheduler}
+        if num_workers is not None:
+            scheduler_kwargs['num_workers'] = num_workers
+
+    if cache_dir is None:
+        data, valid = _read_casa_arrays(filename, memmap=memmap,
+                                        skipdata=skipdata, skipvalid=skipvalid,
+                                        target_chunksize=target_chunksize)
+    else:
+        data, valid = _read_casa_arrays_cached(filename, cache_dir, memmap=memmap,
+                                               skipdata=skipdata, skipvalid=skipvalid,
+                                               target_chunksize=target_chunksize,
+                                               scheduler_kwargs=scheduler_kwargs)
 
     # transpose is dealt with within the cube object
 
     # read in coordinate system object
 
-    desc = getdesc(filename)
+    desc = _getdesc(filename)
 
     casa_cs = desc['_keywords_']['coords']
 
@@ -93,10 +309,13 @@ def load_casa_image(filename, skipdata=False, memmap=True,
     else:
         beam_ = {}
 
-    wcs = coordsys_to_astropy_wcs(casa_cs)
+    wcs = _coordsys_to_wcs(casa_cs)
 
     del casa_cs
 
+    beam = None
+    beams = None
+
     if 'major' in beam_:
         beam = Beam(major=u.Quantity(beam_['major']['value'], unit=beam_['major']['unit']),
                     minor=u.Quantity(beam_['minor']['value'], unit=beam_['minor']['unit']),
@@ -111,20 +330,45 @@ def load_casa_image(filename, skipdata=False, memmap=True,
         nchan = beam_['nChannels']
         assert nbeams == nchan * beam_['nStokes']
 
+        # Rather than constructing one Quantity per channel, extract the raw
+        # values into arrays and attach the units once at the end, using the
+        # units of the first beam, which are only parsed once.
+        unit_names = {param: bdict['*0'][param]['unit']
+                      for param in ('major', 'minor', 'positionangle')}
+        units = {param: u.Unit(name) for param, name in unit_names.items()}
+
+        # Walk the beams once, using the index encoded in each key ('*N',
+        # with N = stokes index * nchan + channel) to place the values rather
+        # than formatting the key of every beam.
+        # The keys are checked to be exactly '*0' to '*{nbeams-1}' so that
+        # every element of the arrays is filled.
+        majors = np.empty(nbeams)
+        minors = np.empty(nbeams)
+        pas = np.empty(nbeams)
+        filled = np.zeros(nbeams, dtype=bool)
+        for key, b in bdict.items():
+            if key[:1] != '*' or not key[1:].isdigit():
+                raise ValueError("Unexpected key in CASA per-plane beams: {0}".format(key))
+            index = int(key[1:])
+            if index >= nbeams or filled[index]:
+                raise ValueError("Unexpected key in CASA per-plane beams: {0}".format(key))
+            filled[index] = True
+            majors[index] = _beam_value(b, 'major', unit_names['major'])
+            minors[index] = _beam_value(b, 'minor', unit_names['minor'])
+            pas[index] = _beam_value(b, 'positionangle', unit_names['positionangle'])
+
+        # The arrays are freshly allocated, so avoid copying them again
+        majors = u.Quantity(majors, units['major'], copy=False)
+        minors = u.Quantity(minors, units['minor'], copy=False)
+        pas = u.Quantity(pas, units['positionangle'], copy=False)
+
         beams = {}
 
         for ii, stokes_name in enumerate(stokes_params):
-
-            majors = [u.Quantity(bdict[f"*{ii*nchan+chan}"]['major']['value'],
-                                 bdict[f"*{ii*nchan+chan}"]['major']['unit']) for chan in range(nchan)]
-            minors = [u.Quantity(bdict[f"*{ii*nchan+chan}"]['minor']['value'],
-                                 bdict[f"*{ii*nchan+chan}"]['minor']['unit']) for chan in range(nchan)]
-            pas = [u.Quantity(bdict[f"*{ii*nchan+chan}"]['positionangle']['value'],
-                              bdict[f"*{ii*nchan+chan}"]['positionangle']['unit']) for chan in range(nchan)]
-
-            beams[stokes_name] = Beams(major=u.Quantity(majors),
-                                       minor=u.Quantity(minors),
-                                       pa=u.Quantity(pas))
+            channels = slice(ii * nchan, (ii + 1) * nchan)
+            beams[stokes_name] = Beams(major=majors[channels],
+                                       minor=minors[channels],
+                                       pa=pas[channels])
     else:
         warnings.warn("No beam information found in CASA image.",
                       BeamWarning)
@@ -167,13 +411,15 @@ def load_casa_image(filename, skipdata=False, memmap=True,
         else:
             mask = None
 
-        if 'beam' in locals():
+        if beam is not None:
             cube = DaskSpectralCube(data, wcs_slice, mask, meta=meta, beam=beam)
-        elif 'beams' in locals():
+        elif beams is not None:
             cube = DaskVaryingResolutionSpectralCube(data, wcs_slice, mask, meta=meta,
                                                      beams=beams['I'])
         else:
             cube = DaskSpectralCube(data, wcs_slice, mask, meta=meta)
+        if scheduler is not None:
+            cube.use_dask_scheduler(scheduler, num_workers=num_workers)
         # with #592, this is no longer true
         # we've already loaded the cube into memory because of CASA
         # limitations, so there's no reason to disallow operations
@@ -194,10 +440,10 @@ def load_casa_image(filename, skipdata=False, memmap=True,
             else:
                 mask[component] = None
 
-            if 'beam' in locals():
+            if beam is not None:
                 data[component] = DaskSpectralCube(data_, wcs_slice, mask[component],
                                                    meta=meta, beam=beam)
-            elif 'beams' in locals():
+            elif beams is not None:
                 data[component] = DaskVaryingResolutionSpectralCube(data_,
                                                                     wcs_slice,
                                                                     mask[component],
@@ -208,6 +454,8 @@ def load_casa_image(filename, skipdata=False, memmap=True,
                                                    meta=meta)
 
             data[component].allow_huge_operations = True
+            if scheduler is not None:
+                data[component].use_dask_scheduler(scheduler, num_workers=num_workers)
 
 
         cube = StokesSpectralCube(stokes_data=data)
@@ -1,6 +1,5 @@
-from __future__ import print_function, absolute_import, division
-
 import os
+import copy
 import shutil
 from itertools import product
 
@@ -9,9 +8,11 @@ import numpy as np
 from numpy.testing import assert_allclose
 from astropy.tests.helper import assert_quantity_allclose
 from astropy import units as u
-from casa_formats_io import coordsys_to_astropy_wcs
+from casa_formats_io import getdesc, coordsys_to_astropy_wcs
 
 from ..io.casa_masks import make_casa_mask
+from ..io import casa_image
+from ..io.casa_image import _coordsys_to_wcs
 from .. import StokesSpectralCube, BooleanArrayMask
 
 from .. import SpectralCube, VaryingResolutionSpectralCube
@@ -128,6 +129,10 @@ def test_casa_read_basic(memmap, bigendian):
     assert_allclose(cube.wcs.pixel_to_world_values(1, 2, 3),
                     [2.406271e+01, 2.993521e+01, 1.421911e+09])
 
+    # The mask should be kept as a boolean array
+
+    assert cube.mask._mask.dtype == bool
+
     # Carry out an operation to make sure the underlying data array works
 
     cube.moment0()
@@ -173,6 +178,251 @@ def test_casa_read_basic_nomask():
                              [1, 1, 1] * u.Jy / u.beam)
 
 
+def test_casa_read_scheduler():
+
+    # Check that the dask scheduler can be set when reading the cube
+
+    cube = SpectralCube.read(os.path.join(DATA, 'basic.image'),
+                             scheduler='threads', num_workers=2)
+
+    assert cube._scheduler_kwargs == {'scheduler': 'threads', 'num_workers': 2}
+
+    cube.moment0()
+
+
+@pytest.mark.skipif(not casa_image.ZARR_INSTALLED, reason='zarr and fsspec are required')
+def test_casa_read_cache_dir(tmp_path):
+
+    # Check that the data and mask can be cached to a zarr store, and that
+    # subsequent reads use the cached copy
+
+    filename = os.path.join(DATA, 'basic.image')
+    cache_dir = str(tmp_path / 'cache')
+
+    cube = SpectralCube.read(filename)
+
+    for iteration in range(2):
+
+        cached_cube = SpectralCube.read(filename, cache_dir=cache_dir)
+
+        assert any(layer.startswith('from-zarr') for layer in cached_cube._data.dask.layers)
+        assert cached_cube.mask._mask.dtype == bool
+        assert len(os.listdir(cache_dir)) == 1
+
+        assert_allclose(cached_cube.unmasked_data[:].value,
+                        cube.unmasked_data[:].value)
+        assert_allclose(cached_cube.mask.include(), cube.mask.include())
+
+    # Without a mask, none should be cached
+
+    cube = SpectralCube.read(os.path.join(DATA, 'nomask.image'), cache_dir=cache_dir)
+    assert any(layer.startswith('from-zarr') for layer in cube._data.dask.layers)
+    assert cube.mask is None
+    assert len(os.listdir(cache_dir)) == 2
+
+
+@pytest.mark.skipif(not casa_image.ZARR_INSTALLED, reason='zarr and fsspec are required')
+def test_casa_read_cache_dir_chunks(tmp_path, monkeypatch):
+
+    # Check that the chunks of cached cubes follow target_chunksize
+
+    original_image_to_dask = casa_image.image_to_dask
+
+    def image_to_dask(*args, target_chunksize=None, **kwargs):
+        # basic.image is a single CASA tile, so emulate the splitting into
+        # smaller chunks that would happen for larger images
+        array = original_image_to_dask(*args, target_chunksize=target_chunksize, **kwargs)
+        if target_chunksize < array.size:
+            array = array.rechunk((1, 1, -1, -1))
+        return array
+
+    monkeypatch.setattr(casa_image, 'image_to_dask', image_to_dask)
+
+    filename = os.path.join(DATA, 'basic.image')
+    cache_dir = str(tmp_path / 'cache')
+
+    for target_chunksize, chunks in ((1, ((1, 1, 1), (4,), (5,))),
+                                     (None, ((3,), (4,), (5,))),
+                                     (1, ((1, 1, 1), (4,), (5,)))):
+
+        cube = SpectralCube.read(filename, target_chunksize=target_chunksize)
+        assert cube._data.chunks == chunks
+
+        cached_cube = SpectralCube.read(filename, target_chunksize=target_chunksize,
+                                        cache_dir=cache_dir)
+        assert cached_cube._data.chunks == chunks
+        assert cached_cube.mask._mask.chunks == chunks
+
+    assert len(os.listdir(cache_dir)) == 2
+
+
+@pytest.mark.skipif(not casa_image.ZARR_INSTALLED, reason='zarr and fsspec are required')
+def test_casa_read_cache_dir_incomplete(tmp_path):
+
+    # Check that incomplete copies in the cache are re-created
+
+    filename = os.path.join(DATA, 'basic.image')
+    cache_dir = str(tmp_path / 'cache')
+
+    SpectralCube.read(filename, cache_dir=cache_dir)
+
+    cache_path = os.path.join(cache_dir, os.listdir(cache_dir)[0])
+    shutil.rmtree(cache_path)
+    os.makedirs(cache_path)
+
+    cube = SpectralCube.read(filename, cache_dir=cache_dir, memmap=False)
+
+    assert_quantity_allclose(cube.unmasked_data[0, 0, :],
+                             [1, 1, 1, 1, 1] * u.Jy / u.beam)
+    assert 'signature' in casa_image.zarr.open_group(cache_path, mode='r').attrs
+
+
+def make_perplanebeams(stokes, nchan, keys=None):
+
+    # Make a synthetic CASA per-plane beam record, with beams that vary with
+    # both Stokes and channel. The minor axis of every other beam is given in
+    # arcmin to check that units are converted. Returns the record along with
+    # the expected beam parameters for each Stokes component.
+
+    record = {'nStokes': len(stokes), 'nChannels': nchan}
+    expected = {name: ([], [], []) for name in stokes}
+
+    if keys is None:
+        keys = range(len(stokes) * nchan)
+
+    for index in keys:
+        istokes, chan = divmod(index, nchan)
+        major = (1 + istokes + 0.1 * chan) * u.arcsec
+        minor = 0.5 * major
+        pa = (10. * chan + istokes) * u.deg
+        if index % 2:
+            minor = minor.to(u.arcmin)
+        record['*{0}'.format(index)] = {
+            'major': {'value': major.value, 'unit': major.unit.to_string()},
+            'minor': {'value': minor.value, 'unit': minor.unit.to_string()},
+            'positionangle': {'value': pa.value, 'unit': pa.unit.to_string()},
+        }
+
+    for index in range(len(stokes) * nchan):
+        params = record['*{0}'.format(index)]
+        for values, param in zip(expected[stokes[index // nchan]],
+                                 ('major', 'minor', 'positionangle')):
+            values.append(u.Quantity(params[param]['value'], params[param]['unit']))
+
+    return record, expected
+
+
+@pytest.fixture
+def perplanebeams_getdesc(monkeypatch):
+
+    # Patch getdesc in the CASA reader so that the perplanebeams record passed
+    # to the returned function is used in place of the restoring beam
+
+    original_getdesc = casa_image.getdesc
+    records = {}
+
+    def getdesc(filename):
+        desc = original_getdesc(filename)
+        imageinfo = desc['_keywords_']['imageinfo']
+        imageinfo.pop('restoringbeam', None)
+        imageinfo['perplanebeams'] = copy.deepcopy(records['perplanebeams'])
+        return desc
+
+    def set_record(record):
+        records['perplanebeams'] = record
+        casa_image.clear_cache()
+
+    monkeypatch.setattr(casa_image, 'getdesc', getdesc)
+    yield set_record
+    casa_image.clear_cache()
+
+
+def test_casa_read_perplanebeams(perplanebeams_getdesc):
+
+    # Check that per-plane beams are parsed correctly, including when beams
+    # use different units or are stored out of order
+
+    stokes = ['I', 'Q']
+    nchan = 3
+
+    for keys in (None, [5, 0, 3, 1, 4, 2]):
+
+        record, expected = make_perplanebeams(stokes, nchan, keys=keys)
+        perplanebeams_getdesc(record)
+
+        cube = StokesSpectralCube.read(os.path.join(DATA, 'basic.image'))
+
+        for name in stokes:
+            assert isinstance(cube[name], VaryingResolutionSpectralCube)
+            majors, minors, pas = expected[name]
+            assert_quantity_allclose(cube[name].beams.major, u.Quantity(majors))
+            assert_quantity_allclose(cube[name].beams.minor, u.Quantity(minors))
+            assert_quantity_allclose(cube[name].beams.pa, u.Quantity(pas))
+
+
+@pytest.mark.parametrize('keys', ([0, 1, 2, 3, 4, -1], [0, 1, 2, 3, 4, 6]))
+def test_casa_read_perplanebeams_invalid(perplanebeams_getdesc, keys):
+
+    # Per-plane beam records that do not contain exactly the keys *0 to *N-1
+    # should not silently result in undefined beams
+
+    record, _ = make_perplanebeams(['I', 'Q'], 3, keys=[0, 1, 2, 3, 4, 5])
+    del record['*5']
+    record['*{0}'.format(keys[-1])] = record['*0']
+    perplanebeams_getdesc(record)
+
+    with pytest.raises(ValueError, match='Unexpected key in CASA per-plane beams'):
+        StokesSpectralCube.read(os.path.join(DATA, 'basic.image'))
+
+
+def test_casa_wcs_cache():
+
+    # The WCS conversion is cached, so make sure that repeated conversions
+    # return equal but independent WCS objects
+
+    coordsys = getdesc(os.path.join(DATA, 'basic.image'))['_keywords_']['coords']
+
+    wcs1 = _coordsys_to_wcs(coordsys)
+    wcs2 = _coordsys_to_wcs(coordsys)
+
+    assert wcs1 is not wcs2
+    assert wcs1.wcs.compare(wcs2.wcs)
+
+    wcs1.wcs.crval[0] += 1
+
+    assert _coordsys_to_wcs(coordsys).wcs.compare(wcs2.wcs)
+
+
+def test_casa_metadata_cache(tmp_path):
+
+    # Check that the image metadata is cached, and that the cache is
+    # invalidated if the image is modified
+
+    filename = str(tmp_path / 'basic.image')
+    shutil.copytree(os.path.join(DATA, 'basic.image'), filename)
+
+    casa_image.clear_cache()
+
+    cube1 = SpectralCube.read(filename)
+    assert os.path.abspath(filename) in casa_image._DESC_CACHE
+    signature = casa_image._DESC_CACHE[os.path.abspath(filename)][0]
+
+    cube2 = SpectralCube.read(filename)
+    assert cube1.wcs.wcs.compare(cube2.wcs.wcs)
+    assert cube1.unit == cube2.unit
+
+    table = os.path.join(filename, 'table.dat')
+    stat = os.stat(table)
+    os.utime(table, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    SpectralCube.read(filename)
+    assert casa_image._DESC_CACHE[os.path.abspath(filename)][0] != signature
+
+    casa_image.clear_cache()
+    assert len(casa_image._DESC_CACHE) == 0
+    assert len(casa_image._WCS_CACHE) == 0
+
+
 @pytest.mark.skipif(not CASA_INSTALLED, reason='CASA tests must be run in a CASA environment.')
 @pytest.mark.parametrize('filename', ('data_adv', 'data_advs', 'data_sdav',
                                       'data_vad', 'data_vsad'),
@@ -260,10 +510,10 @@ def test_casa_mask(data_adv, tmp_path):
     ia.done()
 
     # Test masks
-    # Mask array is broadcasted to the cube shape. Mimic this, switch to ints,
-    # and transpose to match CASA image.
-    compare_mask = np.tile(mask_array, (4, 1, 1)).astype('int16').T
-    assert np.all(compare_mask == casa_mask)
+    # Mask array is broadcasted to the cube shape. Mimic this and transpose to
+    # match CASA image. The comparison is done directly on the boolean array.
+    compare_mask = np.tile(mask_array, (4, 1, 1)).T
+    assert np.all(np.equal(compare_mask, casa_mask))
 
     # Test WCS info
 